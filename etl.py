@@ -1,9 +1,11 @@
 import configparser
-from datetime import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, monotonically_increasing_id
+from pyspark.sql.functions import col
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
+from pyspark.sql.types import StructType, StructField, StringType, IntegerType, LongType, DoubleType, TimestampType
 
 '''
 Yield AWS IAM Credentials located in dl.cfg
@@ -12,8 +14,54 @@ Yield AWS IAM Credentials located in dl.cfg
 config = configparser.ConfigParser()
 config.read('./dl.cfg')
 
-os.environ['AWS_ACCESS_KEY_ID']=config['AWS_CREDS']['']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS_CREDS']['']
+# values may be quoted in dl.cfg; empty keys fall back to the instance profile (f.ex. EMR role)
+AWS_ACCESS_KEY_ID = config['AWS_CREDS']['AWS_ACCESS_KEY_ID'].strip('\'"')
+AWS_SECRET_ACCESS_KEY = config['AWS_CREDS']['AWS_SECRET_ACCESS_KEY'].strip('\'"')
+
+if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+    os.environ['AWS_ACCESS_KEY_ID']=AWS_ACCESS_KEY_ID
+    os.environ['AWS_SECRET_ACCESS_KEY']=AWS_SECRET_ACCESS_KEY
+
+# extra Spark actions (counts, schemas, sample rows) only run when ETL_DEBUG=1
+DEBUG = os.environ.get('ETL_DEBUG') == '1'
+
+'''
+Explicit JSON schemas, so Spark skips the extra schema inference pass over the input
+'''
+
+SONG_SCHEMA = StructType([
+    StructField('song_id', StringType()),
+    StructField('title', StringType()),
+    StructField('artist_id', StringType()),
+    StructField('year', IntegerType()),
+    StructField('duration', DoubleType()),
+    StructField('artist_name', StringType()),
+    StructField('artist_location', StringType()),
+    StructField('artist_latitude', DoubleType()),
+    StructField('artist_longitude', DoubleType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField('ts', LongType()),
+    StructField('userId', StringType()),
+    StructField('firstName', StringType()),
+    StructField('lastName', StringType()),
+    StructField('gender', StringType()),
+    StructField('level', StringType()),
+    StructField('page', StringType()),
+    StructField('sessionId', LongType()),
+    StructField('location', StringType()),
+    StructField('userAgent', StringType()),
+    StructField('artist', StringType()),
+    StructField('song', StringType())
+])
+
+# versions of the jars pulled in through spark.jars.packages, set them to match the cluster:
+# hadoop-aws to its hadoop-common (`hadoop version`), spark-hadoop-cloud (S3A committer
+# bindings) to its Spark and Scala release (`spark-submit --version`)
+HADOOP_AWS_VERSION = "3.3.4"
+SPARK_VERSION = "3.4.1"
+SCALA_VERSION = "2.12"
 
 def create_spark_session():
     
@@ -21,10 +69,45 @@ def create_spark_session():
     get Spark session or initiate the Spark session on AWS Hadoop
     """
     
+    # S3A uploads buffer 64MB blocks off-heap, at most 2 in flight per output stream
+    # (not 8, to keep direct memory at 128MB per writing task); raise
+    # spark.executor.memoryOverhead with spark-submit if executors run many writing tasks
     spark = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:{},org.apache.spark:spark-hadoop-cloud_{}:{}"
+                                       .format(HADOOP_AWS_VERSION, SCALA_VERSION, SPARK_VERSION)) \
+        .config("spark.scheduler.mode", "FAIR") \
+        .config("spark.sql.autoBroadcastJoinThreshold", str(100 * 1024 * 1024)) \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.execution.arrow.pyspark.enabled", "true") \
+        .config("spark.sql.execution.arrow.pyspark.fallback.enabled", "true") \
+        .config("spark.sql.parquet.filterPushdown", "true") \
+        .config("spark.sql.parquet.mergeSchema", "false") \
+        .config("spark.hadoop.parquet.enable.summary-metadata", "false") \
+        .config("spark.sql.parquet.compression.codec", "snappy") \
+        .config("spark.hadoop.parquet.block.size", str(128 * 1024 * 1024)) \
+        .config("spark.hadoop.parquet.page.size", str(1024 * 1024)) \
+        .config("spark.hadoop.parquet.dictionary.page.size", str(2 * 1024 * 1024)) \
+        .config("spark.hadoop.fs.s3a.multipart.size", str(64 * 1024 * 1024)) \
+        .config("spark.hadoop.fs.s3a.fast.upload.buffer", "bytebuffer") \
+        .config("spark.hadoop.fs.s3a.fast.upload.active.blocks", "2") \
+        .config("spark.hadoop.fs.s3a.committer.name", "magic") \
+        .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true") \
+        .config("spark.sql.parquet.output.committer.class",
+                "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter") \
+        .config("spark.sql.sources.commitProtocolClass",
+                "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol") \
         .getOrCreate()
+    
+    # hand the credentials and connection pool size straight to the S3A connector
+    hadoop_conf = spark.sparkContext._jsc.hadoopConfiguration()
+    if AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY:
+        hadoop_conf.set("fs.s3a.access.key", AWS_ACCESS_KEY_ID)
+        hadoop_conf.set("fs.s3a.secret.key", AWS_SECRET_ACCESS_KEY)
+    hadoop_conf.set("fs.s3a.connection.maximum", "200")
+    
     return spark
 
 def process_song_data(spark, input_data, output_data):
@@ -41,13 +124,17 @@ def process_song_data(spark, input_data, output_data):
         spark       : Spark Session
         input_data  : location of song_data JSON files with metadata about songs
         output_data : dimensional tables in parquet format will be stored
+
+    Returns:
+        df          : cached song data, reused for the songplays join
     """
     
     # read song data file
     print('Read song data from JSON file')
-    df = spark.read.json(os.path.join(input_data, "song-data/A/A/A/*.json"))
-    print(df.count())
-    df.printSchema()
+    df = spark.read.schema(SONG_SCHEMA).json(os.path.join(input_data, "song-data/A/A/A/*.json")).cache()
+    if DEBUG:
+        print(df.count())
+        df.printSchema()
     
     # create temp view for Spark SQL queries
     print('create temp view for Spark SQL queries')
@@ -56,24 +143,27 @@ def process_song_data(spark, input_data, output_data):
     # extract columns to create songs table
     print('Song table: ')
     songs_table = spark.sql("""
-                            SELECT DISTINCT song_id, title, artist_id, year, duration
+                            SELECT song_id, title, artist_id, year, duration,
+                                pmod(hash(artist_id), 64) AS artist_bucket
                             FROM songs_data
                             WHERE song_id IS NOT NULL
                             """).dropDuplicates(['song_id'])
-    print(songs_table.limit(5).toPandas())
+    if DEBUG:
+        print(songs_table.limit(5).toPandas())
     
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy('year', 'artist_id').parquet(os.path.join(output_data, 'songs.parquet'), 'overwrite')
+    # write songs table to parquet files partitioned by year and artist bucket
+    songs_table.repartition('year', 'artist_bucket').write.partitionBy('year', 'artist_bucket').parquet(os.path.join(output_data, 'songs.parquet'), 'overwrite')
     print("songs.parquet completed")
 
     # extract columns to create artists table
     print('Artist table: ')
     artists_table = spark.sql("""
-                              SELECT DISTINCT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+                              SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude
                               FROM songs_data 
                               WHERE artist_id IS NOT NULL
                               """).dropDuplicates(['artist_id'])
-    print(artists_table.limit(5).toPandas())
+    if DEBUG:
+        print(artists_table.limit(5).toPandas())
     
     # write artists table to parquet files
     artists_table.write.parquet(os.path.join(output_data, 'artists.parquet'), 'overwrite')
@@ -81,6 +171,8 @@ def process_song_data(spark, input_data, output_data):
     
     print("process_song_data IS DONE")
     
+    return df
+    
 def process_log_data(spark, input_data, output_data):
     
     """
@@ -96,46 +188,44 @@ def process_log_data(spark, input_data, output_data):
         spark       : Spark Session
         input_data  : location of song_data JSON files with metadata about events
         output_data : dimensional tables in parquet format will be stored
+
+    Returns:
+        df          : persisted NextSong events, reused for the songplays join
     """
     
     # read log data file
     print('Read log data from JSON file')
-    df = spark.read.json(os.path.join(input_data,"log_data/*/*/*.json"))
-    print(df.count())
-    df.printSchema()
+    df = spark.read.schema(LOG_SCHEMA).json(os.path.join(input_data,"log_data/*/*/*.json"))
+    
+    # filter by actions for song plays once, keep only the columns used downstream
+    # and create datetime column from original epoch-millis timestamp column
+    df = df.filter("page = 'NextSong'") \
+        .select('ts', 'userId', 'firstName', 'lastName', 'gender', 'level',
+                'sessionId', 'location', 'userAgent', 'artist', 'song') \
+        .withColumn("datetime", (col('ts') / 1000).cast(TimestampType())) \
+        .persist(StorageLevel.MEMORY_AND_DISK)
+    if DEBUG:
+        print(df.count())
+        df.printSchema()
     
     # create temp view for Spark SQL queries
     print('create temp view for Spark SQL queries - logs_data')
     df.createOrReplaceTempView("logs_data")
-    
-    # filter by actions for song plays
-    songplays_table = df['ts', 'userId', 'level','sessionId', 'location', 'userAgent'] 
 
     # extract columns for users table
     print('Users table: ')
     users_table = spark.sql("""
-                              SELECT DISTINCT userId, firstName, lastName, gender, level
+                              SELECT userId, firstName, lastName, gender, level
                               FROM logs_data 
-                              WHERE page = 'NextSong' AND userId IS NOT NULL
+                              WHERE userId IS NOT NULL
                               """).dropDuplicates(['userId'])
-    print(users_table.limit(5).toPandas())
+    if DEBUG:
+        print(users_table.limit(5).toPandas())
     
     # write users table to parquet files
     users_table.write.parquet(os.path.join(output_data, 'users.parquet'), 'overwrite')
     print("users.parquet completed")
 
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda x: str(int(int(x) / 1000)))
-    df = df.withColumn('timestamp', get_timestamp(df.ts))
-    
-    # create datetime column from original timestamp column
-    get_datetime = udf(lambda x: str(datetime.fromtimestamp(int(x) / 1000.0)))
-    df = df.withColumn("datetime", get_datetime(df.ts))
-    
-    # create temp view for SQL queries
-    print('create temp view for Spark SQL queries - time_data')
-    df.createOrReplaceTempView("time_data")
-    
     # extract columns to create time table
     print('Time table: ')
     time_table = spark.sql("""
@@ -146,49 +236,105 @@ def process_log_data(spark, input_data, output_data):
                                month(datetime) AS month,
                                year(datetime) AS year,
                                dayofweek(datetime) AS weekday
-                           FROM time_data
+                           FROM logs_data
                            """)
-    print(time_table.limit(5).toPandas())
+    if DEBUG:
+        print(time_table.limit(5).toPandas())
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'time.parquet'), 'overwrite')
+    time_table.repartition('year', 'month').write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'time.parquet'), 'overwrite')
     print("time.parquet completed")
+    
+    print("process_log_data IS DONE")
+    
+    return df
+    
+def process_songplays_data(spark, output_data, songs_df, logs_df):
+    
+    """
+    Purpose:
+        Join song and log/event data using Spark and output as parquet to S3
 
-    # read in song data to use for songplays table
-    song_df = spark.read.json(os.path.join(input_data, "song-data/A/A/A/*.json"))
+    Description:
+        Set up temporary views of the data read by process_song_data and
+        process_log_data, so the songplays fact table may be built with a
+        Spark SQL join
+        
+    Parameters:
+        spark       : Spark Session
+        output_data : fact table in parquet format will be stored
+        songs_df    : song data returned by process_song_data
+        logs_df     : log/event data returned by process_log_data
+    """
     
-    # create temp view for Spark SQL queries
-    print('create temp view for Spark SQL queries - song_df')
-    song_df.createOrReplaceTempView("songs_data")
+    # reuse song and log data already read for the dimension tables
+    print('create temp view for Spark SQL queries - songs_data, logs_data')
+    songs_df.createOrReplaceTempView("songs_data")
+    logs_df.createOrReplaceTempView("logs_data")
+    
+    # keep one song per artist name and title, so the join yields at most one row per event
+    print('create temp view for Spark SQL queries - artist_songs')
+    artist_songs = spark.sql("""
+                             SELECT song_id, artist_id, artist_name, title
+                             FROM (
+                                 SELECT song_id, artist_id, artist_name, title,
+                                     row_number() OVER (PARTITION BY artist_name, title ORDER BY song_id) AS song_rank
+                                 FROM songs_data
+                                 WHERE artist_name IS NOT NULL AND title IS NOT NULL
+                             ) AS ranked_songs
+                             WHERE song_rank = 1
+                             """)
+    artist_songs.createOrReplaceTempView("artist_songs")
 
     # extract columns from joined song and log datasets to create songplays table
     print('Songplays table: ')
     songplays_table = spark.sql("""
-                                    SELECT monotonically_increasing_id() AS songplay_id,
-                                        to_timestamp(logs_data.ts/1000) AS start_time,
-                                        month(to_timestamp(logs_data.ts/1000)) AS month,
-                                        year(to_timestamp(logs_data.ts/1000)) AS year,
-                                        logs_data.userId AS user_id,
-                                        logs_data.level AS level,
-                                        songs_data.song_id AS song_id,
-                                        songs_data.artist_id AS artist_id,
-                                        logs_data.sessionId AS session_id,
-                                        logs_data.location AS location,
-                                        logs_data.userAgent AS user_agent
-                                    FROM logs_data 
-                                    JOIN songs_data ON logs_data.artist = songs_data.artist_name
+                                    SELECT songplay_id,
+                                        start_time,
+                                        month(start_time) AS month,
+                                        year(start_time) AS year,
+                                        user_id,
+                                        level,
+                                        song_id,
+                                        artist_id,
+                                        session_id,
+                                        location,
+                                        user_agent
+                                    FROM (
+                                        SELECT /*+ BROADCAST(artist_songs) */
+                                            monotonically_increasing_id() AS songplay_id,
+                                            logs_data.datetime AS start_time,
+                                            logs_data.userId AS user_id,
+                                            logs_data.level AS level,
+                                            artist_songs.song_id AS song_id,
+                                            artist_songs.artist_id AS artist_id,
+                                            logs_data.sessionId AS session_id,
+                                            logs_data.location AS location,
+                                            logs_data.userAgent AS user_agent
+                                        FROM logs_data 
+                                        JOIN artist_songs ON logs_data.artist = artist_songs.artist_name
+                                            AND logs_data.song = artist_songs.title
+                                    ) AS songplays
                                 """)
-    print(songplays_table.limit(5).toPandas())
-    
-    #songplays_table = songplays_table.selectExpr("start_time")
-    songplays_table.select(monotonically_increasing_id().alias('songplay_id')).collect()
+    if DEBUG:
+        print(songplays_table.limit(5).toPandas())
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'songplays.parquet'), 'overwrite')
+    songplays_table.repartition('year', 'month').write.partitionBy('year', 'month').parquet(os.path.join(output_data, 'songplays.parquet'), 'overwrite')
     print("songplays.parquet completed")
     
-    print("process_log_data IS DONE")
+    print("process_songplays_data IS DONE")
+    
+
+def run_in_pool(spark, pool, stage, *args):
     
+    """
+    Run a processing stage with its Spark jobs assigned to a FAIR scheduler pool,
+    so stages submitted from different threads share the cluster instead of queueing
+    """
+    
+    spark.sparkContext.setLocalProperty("spark.scheduler.pool", pool)
+    return stage(spark, *args)
 
 def main():
     
@@ -201,10 +347,20 @@ def main():
     spark = create_spark_session()
     
     input_data = "s3a://udacity-dend/"
-    output_data = "s3://COPY_UR_OWN_LINK_HERE"
+    output_data = "s3a://COPY_UR_OWN_LINK_HERE"
 
-    process_song_data(spark, input_data, output_data) 
-    process_log_data(spark, input_data, output_data)
+    # song and log stages share no data, so run them as concurrent Spark jobs
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        songs_future = executor.submit(run_in_pool, spark, "songs", process_song_data, input_data, output_data)
+        logs_future = executor.submit(run_in_pool, spark, "logs", process_log_data, input_data, output_data)
+        songs_df, logs_df = songs_future.result(), logs_future.result()
+    
+    # release the cached song and log data even if the songplays write fails
+    try:
+        process_songplays_data(spark, output_data, songs_df, logs_df)
+    finally:
+        songs_df.unpersist()
+        logs_df.unpersist()
     
 
 if __name__ == "__main__":